@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Checks how much memory the heavier commands use on a big fake history.
+
+Usage: python3 bench_memory.py [number of polls]
+
+Everything runs against a throwaway sqlite DB, with nothing sent to slack.
+Exits nonzero if any command's peak allocation (per tracemalloc) is over
+its budget.
+"""
+import datetime
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+
+os.environ['DEBUG'] = 'true'
+os.chdir(tempfile.mkdtemp())
+
+import flask  # noqa: E402
+
+import main  # noqa: E402
+
+
+TEAM_ID = 'TBENCH'
+NUM_VOTERS = 200
+VOTES_PER_POLL = 30
+WORDS = ('I have a dog cat kid son daughter mom dad parent school college '
+         'university once twice lived in Paris Tokyo 3 12 100 climbed swam '
+         'met ate wrote broke won lost').split()
+
+MB = 1024 * 1024
+# name -> (function to run, peak bytes allowed)
+BENCHMARKS = {
+    'stats': (lambda: main.handle_stats('', 'C', 'U0'), 4 * MB),
+    'mystats': (lambda: main.handle_mystats('', 'C', 'U0'), 1 * MB),
+    'rankings': (lambda: main._rankings(TEAM_ID, None), 1 * MB),
+    'tellers': (lambda: main._tellers(TEAM_ID, None), 3 * MB),
+    'twins': (lambda: main._vote_matrix(TEAM_ID), 8 * MB),
+}
+
+
+def _seed(num_polls):
+    main.db.create_all()
+    start = datetime.datetime(2015, 1, 1)
+    statement_id = 0
+    users, statements, votes = [], [], []
+    for user_id in range(1, num_polls + 1):
+        users.append({'id': user_id, 'team_id': TEAM_ID,
+                      'name': f'Teller {user_id}'})
+        timestamp = start + datetime.timedelta(days=user_id)
+        lie = random.randrange(3)
+        for i in range(3):
+            statement_id += 1
+            statements.append({
+                'id': statement_id, 'team_id': TEAM_ID, 'user_id': user_id,
+                'text': ' '.join(random.sample(WORDS, random.randint(4, 12))),
+                'timestamp': timestamp, 'veracity': i != lie,
+            })
+        for voter in random.sample(range(NUM_VOTERS), VOTES_PER_POLL):
+            votes.append({'team_id': TEAM_ID, 'slack_user_id': f'U{voter}',
+                          'statement_id': statement_id - random.randrange(3)})
+
+    for model, rows in ((main.User, users), (main.Statement, statements),
+                        (main.Vote, votes)):
+        main.db.session.bulk_insert_mappings(model, rows)
+    main.db.session.commit()
+
+
+def _measure(fn):
+    main.db.session.remove()
+    main._vote_matrices.clear()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def main_():
+    num_polls = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    random.seed(0)
+    over_budget = []
+    with main.app.test_request_context():
+        flask.g.team_id = TEAM_ID
+        flask.g.suppress_slack_posts = True
+        _seed(num_polls)
+        for name, (fn, budget) in BENCHMARKS.items():
+            peak = _measure(fn)
+            print(f'{name:10} {peak / MB:7.2f} MB peak '
+                  f'(budget {budget / MB:.0f} MB)')
+            if peak > budget:
+                over_budget.append(name)
+
+    if over_budget:
+        print(f'Over budget: {", ".join(over_budget)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_()
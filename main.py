@@ -1,19 +1,31 @@
 #!/usr/bin/env python3
 import collections
+import cProfile
 import datetime
 import functools
+import heapq
+import itertools
 import json
 import logging
+import marshal
+import pstats
 import random
 import re
 import os
+import secrets
+import threading
+import time
+import urllib.parse
 
 import flask
 import flask_sqlalchemy
 import requests
 import pytz
+import sqlalchemy
 
 import app_secrets
+import search
+import similarity
 import stats
 import util
 
@@ -51,12 +63,36 @@ class InvalidInput(Exception):
     pass
 
 
-class User(db.Model):
+class Team(db.Model):
+    # Slack's team (workspace) id, e.g. T0123ABCD.
+    id = db.Column(db.String(32), primary_key=True)
+    name = db.Column(db.String(64), nullable=True)
+    bot_token = db.Column(db.String(128), nullable=False)
+
+
+class TeamScoped(object):
+    """Mixin for models whose rows belong to a single workspace.
+
+    Every query on these should filter on team_id; each has an index
+    starting with team_id for the way it's usually queried.
+    """
+    team_id = db.Column(db.String(32), nullable=False)
+
+
+class User(TeamScoped, db.Model):
+    __table_args__ = (
+        db.Index('ix_user_team_id', 'team_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), nullable=False)
 
 
-class Statement(db.Model):
+class Statement(TeamScoped, db.Model):
+    __table_args__ = (
+        db.Index('ix_statement_team_id_timestamp', 'team_id', 'timestamp'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column('uid', db.ForeignKey(User.id), nullable=False)
     user = db.relationship("User")
@@ -69,7 +105,13 @@ class Statement(db.Model):
     veracity = db.Column(db.Boolean)
 
 
-class Vote(db.Model):
+class Vote(TeamScoped, db.Model):
+    __table_args__ = (
+        db.Index('ix_vote_team_id_user_id', 'team_id', 'user_id'),
+        # For joining to Statement, which all the aggregations do.
+        db.Index('ix_vote_team_id_statement_id', 'team_id', 'statement_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     slack_user_id = db.Column('user_id', db.String(32), nullable=True)
     statement_id = db.Column(db.ForeignKey(Statement.id), nullable=False)
@@ -77,7 +119,11 @@ class Vote(db.Model):
     statement = db.relationship("Statement")
 
 
-class Poll(db.Model):
+class Poll(TeamScoped, db.Model):
+    __table_args__ = (
+        db.Index('ix_poll_team_id_closed', 'team_id', 'closed'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column('uid', db.ForeignKey(User.id), nullable=False)
     user = db.relationship("User")
@@ -90,10 +136,54 @@ class Poll(db.Model):
     timestamp = db.Column(db.DateTime, nullable=False)
 
 
+def _current_team_id():
+    """The Slack team the current request came from."""
+    return flask.g.team_id
+
+
+def _bot_token(team_id):
+    # Not cached: when a workspace reinstalls us, its token changes, and
+    # every instance needs to pick up the new one.  It's a primary key
+    # lookup, next to an HTTP request to slack.
+    team = Team.query.get(team_id) if team_id else None
+    if team:
+        return team.bot_token
+    elif team_id and team_id == app_secrets.TEAM_ID:
+        # The workspace we were installed in before we stored tokens.
+        return app_secrets.BOT_TOKEN
+    raise SlackError(f"We're not installed in workspace {team_id}!")
+
+
+class Report(TeamScoped, db.Model):
+    """A snapshot of the data behind a year's leaderboard and winners.
+
+    See _snapshot_report().
+    """
+    __table_args__ = (
+        db.UniqueConstraint('team_id', 'year'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    year = db.Column(db.Integer, nullable=False)
+    # JSON, {part: data} for each part in REPORT_PARTS; sized for MEDIUMTEXT.
+    data = db.Column(db.Text(2 ** 24 - 1), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+
+class Profile(TeamScoped, db.Model):
+    # Random, since it's all that's needed to download the profile.
+    id = db.Column(db.String(32), primary_key=True)
+    command = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    # pstats-loadable dump; sized for MEDIUMBLOB in MySQL.
+    data = db.Column(db.LargeBinary(2 ** 24 - 1), nullable=False)
+
+
 def call_slack_api(call, data=None, use_json=False):
     data = data or {}
     logging.debug("Sending to slack: %s", data)
-    headers = {'Authorization': f'Bearer {app_secrets.BOT_TOKEN}'}
+    headers = {
+        'Authorization': f'Bearer {_bot_token(_current_team_id())}'}
     if use_json:
         kwargs = {'json': data}
     else:
@@ -108,6 +198,9 @@ def call_slack_api(call, data=None, use_json=False):
 
 
 def send_message(channel, message):
+    if flask.g.get('suppress_slack_posts'):
+        logging.info("Not posting to slack: %s", message)
+        return {'ts': None}
     return call_slack_api(
         'chat.postMessage',
         {'channel': channel, 'text': message,
@@ -144,7 +237,15 @@ def handle_new(args, channel, user_id):
     }]}
 
 
-def _get_user_real_name(user_id):
+# Long enough that a page of names is only looked up once, short enough that
+# people who change their name see it change.
+REAL_NAME_CACHE_SECONDS = 60 * 60
+
+
+@util.ttl_memo(REAL_NAME_CACHE_SECONDS)
+def _get_user_real_name(team_id, user_id):
+    # team_id is always the current team; it's an argument so that we cache
+    # each workspace's users separately.
     resp = call_slack_api('users.info', {'user': user_id})
     return resp['user']['profile']['real_name'] or '@%s' % resp['user']['name']
 
@@ -159,7 +260,8 @@ def handle_close(args, channel, user_id):
     if lie not in EMOJIS:
         return usage
 
-    poll = Poll.query.filter_by(closed=False).one_or_none()
+    team_id = _current_team_id()
+    poll = Poll.query.filter_by(team_id=team_id, closed=False).one_or_none()
     if not poll:
         return "There's no vote open!"
 
@@ -187,13 +289,29 @@ def handle_close(args, channel, user_id):
         if reaction['name'] in EMOJIS:
             statement_id = statements[EMOJIS.index(reaction['name'])].id
             db.session.add_all([
-                Vote(slack_user_id=u, statement_id=statement_id)
+                Vote(team_id=team_id, slack_user_id=u,
+                     statement_id=statement_id)
                 for u in reaction['users']])
 
     resp = send_message(
         channel, "The lie was :%s:!  Thanks for playing." % lie)
 
+    # Commit the new snapshot along with the votes, so no one can see one
+    # without the other.  (Autoflush means the snapshot sees the votes.)  If
+    # it fails, we roll back just the snapshot -- the votes matter more --
+    # and delete the old one, which is now out of date; until the daily
+    # cron fills it back in, we'll compute the report from scratch.
+    year = statements[0].timestamp.year
+    try:
+        with db.session.begin_nested():
+            _snapshot_report(team_id, year)
+    except Exception as e:
+        logging.exception(e)
+        Report.query.filter_by(team_id=team_id, year=year).delete()
+
     db.session.commit()
+    if team_id in _vote_matrices:
+        _vote_matrix(team_id)   # add the new votes while we're here
     return ':+1:'
 
 
@@ -207,7 +325,7 @@ def _maybe_filter_stmts_for_year(q, year):
             .filter(Statement.timestamp < end))
 
 
-def _rankings(year):
+def _rankings(team_id, year):
     """Returns list of dicts, unsorted.
 
     Keys of dicts:
@@ -220,6 +338,8 @@ def _rankings(year):
     votes = (db.session.query(Vote.slack_user_id, db.func.count(Vote.id),
                               Statement.veracity)
              .select_from(Vote).join(Statement)
+             .filter(Statement.team_id == team_id)
+             .filter(Vote.team_id == team_id)
              .filter(Statement.veracity.isnot(None)))
 
     votes = _maybe_filter_stmts_for_year(votes, year)
@@ -261,24 +381,139 @@ def _coerce_year(args, heading):
         raise InvalidInput("%s doesn't seem like a valid year to me!" % args)
 
 
-@_in_channel
-def handle_leaderboard(args, channel, user_id):
-    year, heading = _coerce_year(args, "%s Leaderboard")
+LEADERBOARD_PAGE_SIZE = 10
+DEFAULT_LEADERBOARD_METRIC = 'shrewdest'
+# name -> function of a _rankings() dict; higher is better.
+LEADERBOARD_METRICS = {
+    'shrewdest': lambda data: data['lb'],
+    'accuracy': lambda data: data['correct'] / data['total'],
+    'prolific': lambda data: data['total'],
+    'credulous': lambda data: -data['ub'],
+}
+
+# (team id, year) -> {
+#     'last_vote_id': the team's newest vote when this was computed,
+#     'rankings': _report_part(team_id, year, 'rankings'),
+#     'ranked': {metric: rankings, best first},
+#     'positions': {metric: {slack user id: index into ranked[metric]}},
+# }
+_rankings_cache = {}
+
+
+def _last_vote_id(team_id):
+    return (db.session.query(db.func.max(Vote.id))
+            .filter(Vote.team_id == team_id)
+            .scalar())
+
+
+def _cached_rankings(team_id, year):
+    last_vote_id = _last_vote_id(team_id)
+    entry = _rankings_cache.get((team_id, year))
+    if entry is None or entry['last_vote_id'] != last_vote_id:
+        entry = _rankings_cache[(team_id, year)] = {
+            'last_vote_id': last_vote_id,
+            'rankings': _report_part(team_id, year, 'rankings'),
+            'ranked': {},
+            'positions': {},
+        }
+    return entry
+
+
+def _rank_key(metric):
+    metric_fn = LEADERBOARD_METRICS[metric]
+    # Break ties the same way every time, so pages don't shuffle.
+    return lambda data: (metric_fn(data), data['total'], data['user_id'])
+
+
+def _ranked(entry, metric, limit=None):
+    """Returns the _cached_rankings() entry's rankings, best first by metric.
+
+    If we haven't already sorted everyone, and only want the first few, we
+    pick those out with a heap instead.
+    """
+    ranked = entry['ranked'].get(metric)
+    if ranked is None:
+        if limit is not None and limit < len(entry['rankings']):
+            return heapq.nlargest(limit, entry['rankings'],
+                                  key=_rank_key(metric))
+        ranked = entry['ranked'][metric] = sorted(
+            entry['rankings'], key=_rank_key(metric), reverse=True)
+        entry['positions'][metric] = {
+            data['user_id']: i for i, data in enumerate(ranked)}
+    return ranked[:limit]
+
+
+def _rank_of(team_id, year, metric, user_id):
+    """Returns (position, total, _rankings() dict) for user_id, or None."""
+    entry = _cached_rankings(team_id, year)
+    ranked = _ranked(entry, metric)
+    i = entry['positions'][metric].get(user_id)
+    if i is None:
+        return None
+    return i + 1, len(ranked), ranked[i]
+
+
+def _parse_leaderboard_args(args, heading):
+    year = None
+    metric = DEFAULT_LEADERBOARD_METRIC
+    page = 1
+    for arg in args.split():
+        if arg in LEADERBOARD_METRICS:
+            metric = arg
+        elif arg.isdigit() and len(arg) == 4:
+            year = int(arg)
+        elif arg.isdigit() and int(arg) > 0:
+            page = int(arg)
+        else:
+            raise InvalidInput(
+                f"{arg} doesn't seem like a year, page, or one of "
+                f"{', '.join(LEADERBOARD_METRICS)} to me!")
 
-    rankings = _rankings(year)
-    rankings = sorted(rankings, reverse=True,
-                      key=lambda data: (data['lb'], random.random()))
+    heading = heading % (year or 'All Time')
+    if metric != DEFAULT_LEADERBOARD_METRIC:
+        heading = f'{heading} (by {metric})'
+    return year, heading, metric, page
 
+
+@_in_channel
+def handle_leaderboard(args, channel, user_id):
+    year, heading, metric, page = _parse_leaderboard_args(
+        args, "%s Leaderboard")
+
+    team_id = _current_team_id()
+    start = (page - 1) * LEADERBOARD_PAGE_SIZE
+    rankings = _ranked(_cached_rankings(team_id, year), metric,
+                       limit=start + LEADERBOARD_PAGE_SIZE)[start:]
+    if not rankings:
+        return f"{heading}: there's no one on page {page}!"
+
+    if page > 1:
+        heading = f'{heading}, page {page}'
     return "%s:\n%s" % (heading, '\n'.join(
         '%s. %s with %s' % (
-            i + 1, _get_user_real_name(data['user_id']), data['desc'])
-        for i, data in enumerate(rankings[:10])))
+            start + i + 1, _get_user_real_name(team_id, data['user_id']),
+            data['desc'])
+        for i, data in enumerate(rankings)))
 
 
-def _tellers(year):
+def handle_myrank(args, channel, user_id):
+    year, heading, metric, _ = _parse_leaderboard_args(args, "%s Leaderboard")
+    rank = _rank_of(_current_team_id(), year, metric, user_id)
+    if not rank:
+        return (f"You're not on the {heading} -- it takes at least 5 votes "
+                f"to be ranked!")
+
+    position, total, data = rank
+    return (f"You're #{position} of {total} on the {heading}, "
+            f"with {data['desc']}.")
+
+
+def _tellers(team_id, year):
     votes = (db.session.query(User.id, User.name, Statement.veracity,
                               db.func.count(Vote.id))
              .select_from(Vote).join(Statement).join(User)
+             .filter(Statement.team_id == team_id)
+             .filter(Vote.team_id == team_id)
              .filter(Statement.veracity.isnot(None)))
 
     votes = _maybe_filter_stmts_for_year(votes, year)
@@ -320,8 +555,10 @@ def _first_by(l, f):
 def handle_winners(args, channel, user_id):
     year, heading = _coerce_year(args, "%s Winners")
 
-    rankings = _rankings(year)
-    tellers = _tellers(year)
+    team_id = _current_team_id()
+    report = _report(team_id, year)
+    rankings = report['rankings']
+    tellers = report['tellers']
 
     winners = [
         # (category, data obj)
@@ -335,7 +572,7 @@ def handle_winners(args, channel, user_id):
     return '%s:\n%s' % (heading, '\n'.join(
         '%s: %s with %s' % (
             category,
-            data.get('name') or _get_user_real_name(data['user_id']),
+            data.get('name') or _get_user_real_name(team_id, data['user_id']),
             data['desc'])
         for category, data in winners))
 
@@ -346,18 +583,18 @@ def _get_count(stmts):
 
 def _make_common_lies_stat_getter(key_fn, desc_dict):
     def getter(stmts):
-        stmts_by_user = collections.defaultdict(list)
-        for stmt in stmts:
-            stmts_by_user[stmt.user_id].append(stmt)
-
+        # stmts are ordered by user, so each user's are together.
         by_position = collections.defaultdict(int)
-        for stmts_for_user in stmts_by_user.values():
+        for _, stmts_for_user in itertools.groupby(
+                stmts, key=lambda stmt: stmt.user_id):
             if key_fn:
                 stmts_for_user = sorted(stmts_for_user, key=key_fn)
             for index, stmt in enumerate(stmts_for_user):
                 if not stmt.veracity:
                     by_position[index] += 1
         total = sum(by_position.values())
+        if not total:
+            return None
 
         sorted_positions = sorted(
             by_position.items(), key=lambda item: item[1])
@@ -373,10 +610,14 @@ def _make_common_lies_stat_getter(key_fn, desc_dict):
 
 def _make_fraction_lies_stat_getter(description, predicate):
     def getter(stmts):
-        matching = [stmt for stmt in stmts if predicate(stmt)]
-        num = len(matching)
-        lies = [stmt for stmt in matching if not stmt.veracity]
-        pct = 100 * float(len(lies)) / float(num)
+        num = lies = 0
+        for stmt in stmts:
+            if predicate(stmt):
+                num += 1
+                lies += not stmt.veracity
+        if not num:
+            return None
+        pct = 100 * float(lies) / float(num)
         return f'Of {num} statements {description}, {pct:.0f}% are lies.'
 
     return getter
@@ -405,9 +646,11 @@ def _get_common_words_stats(stmts):
 
     return [
         f"The word '{true_only[0]}' is the most common word in truths "
-        f"({true_only[1]} times) which does not appear in any lie.",
+        f"({true_only[1]} times) which does not appear in any lie."
+        if true_only else None,
         f"The word '{false_only[0]}' is the most common word in lies "
-        f"({false_only[1]} times) which does not appear in any truth.",
+        f"({false_only[1]} times) which does not appear in any truth."
+        if false_only else None,
     ]
 
 
@@ -443,25 +686,84 @@ _STAT_GETTERS = [
 ]
 
 
+def _stat_groups(team_id, year):
+    """Returns the output of each stat getter, as a list, count first.
+
+    Getters return None (or lists containing None) for stats that don't
+    make sense with the data we have; those are left out.
+    """
+    # Just the columns the getters need, as plain tuples rather than ORM
+    # objects, which are several times bigger.
+    stmts = (db.session.query(Statement.user_id, Statement.text,
+                              Statement.veracity)
+             .filter(Statement.team_id == team_id)
+             .filter(Statement.veracity.isnot(None)))
+    stmts = _maybe_filter_stmts_for_year(stmts, year)
+    stmts = stmts.order_by(Statement.user_id, Statement.timestamp,
+                           Statement.id).all()
+
+    groups = []
+    for getter in [_get_count] + _STAT_GETTERS:
+        stat = getter(stmts)
+        if not isinstance(stat, (list, tuple)):
+            stat = [stat]
+        stat = [s for s in stat if s is not None]
+        if stat:
+            groups.append(stat)
+    return groups
+
+
 @_in_channel
 def handle_stats(args, channel, user_id):
     year, heading = _coerce_year(args, "%s Stats")
-    stmts = Statement.query.filter(Statement.veracity.isnot(None))
-    stmts = _maybe_filter_stmts_for_year(stmts, year)
-    stmts = stmts.order_by(Statement.timestamp).all()
+    count, *getter_groups = _stat_groups(_current_team_id(), year)
 
-    stats = []
-    getters = _STAT_GETTERS[:]
-    random.shuffle(getters)
-    for getter in [_get_count] + getters[:]:
-        stat = getter(stmts)
-        if isinstance(stat, (list, tuple)):
-            stats.extend(stat)
-        else:
-            stats.append(stat)
+    stats = count[:]
+    random.shuffle(getter_groups)
+    for group in getter_groups:
+        stats.extend(group)
     return '{}:{}'.format(heading, ''.join(f'\n- {s}' for s in stats))
 
 
+# part -> function(team_id, year) computing it.  (The stats command is
+# turned off, so there's no point snapshotting stats.)
+REPORT_PARTS = {
+    'rankings': _rankings,
+    'tellers': _tellers,
+}
+
+
+def _report(team_id, year, parts=tuple(REPORT_PARTS)):
+    """Returns {part: REPORT_PARTS[part](team_id, year)} for each of parts.
+
+    The parts come from the year's snapshot if we have one.  Reports only
+    change when a poll closes, and we snapshot the year's report each time
+    one does (or delete the old snapshot, if that fails), so any snapshot we
+    have is up to date.
+    """
+    if year:
+        report = (Report.query.filter_by(team_id=team_id, year=year)
+                  .one_or_none())
+        if report:
+            data = json.loads(report.data)
+            return {part: data[part] for part in parts}
+    return {part: REPORT_PARTS[part](team_id, year) for part in parts}
+
+
+def _report_part(team_id, year, part):
+    return _report(team_id, year, (part,))[part]
+
+
+def _snapshot_report(team_id, year):
+    report = (Report.query.filter_by(team_id=team_id, year=year)
+              .one_or_none()
+              or Report(team_id=team_id, year=year))
+    report.data = json.dumps({part: compute(team_id, year)
+                              for part, compute in REPORT_PARTS.items()})
+    report.timestamp = datetime.datetime.utcnow()
+    db.session.add(report)
+
+
 VERACITY_TO_VOTE_TYPE = {
     False: 'correct',
     True: 'incorrect',
@@ -469,9 +771,11 @@ VERACITY_TO_VOTE_TYPE = {
 
 
 @util.memo
-def _global_average(year):
+def _global_average(team_id, year):
     votes = (db.session.query(Statement.veracity, db.func.count(Vote.id))
              .select_from(Vote).join(Statement)
+             .filter(Statement.team_id == team_id)
+             .filter(Vote.team_id == team_id)
              .filter(Statement.veracity.isnot(None)))
     votes = _maybe_filter_stmts_for_year(votes, year)
     votes = votes.group_by(Statement.veracity).all()
@@ -484,9 +788,11 @@ def _global_average(year):
 
 def handle_mystats(args, channel, user_id):
     year, heading = _coerce_year(args, "Your %s Stats")
+    team_id = _current_team_id()
     votes = (db.session.query(Statement.timestamp, Statement.veracity,
                               User.name)
              .select_from(Vote).join(Statement).join(User)
+             .filter(Vote.team_id == team_id)
              .filter(Vote.slack_user_id == user_id)
              .filter(Statement.veracity.isnot(None)))
     votes = _maybe_filter_stmts_for_year(votes, year)
@@ -500,18 +806,16 @@ def handle_mystats(args, channel, user_id):
     total = len(votes)
     percent = 100 * float(correct) / float(total)
 
-    def pvalue_text(pnum, comparison):
-        if pnum > 0.95:
+    def pvalue_text(frac, comparison):
+        # Two-sided, since we don't know in advance which way you'll differ;
+        # p < 0.1 is the same cutoff as 0.05 in each direction.
+        pnum = stats.binom_test(correct, total, frac)
+        if pnum >= 0.1:
+            return f'indistinguishable from {comparison}'
+        elif correct > total * frac:
             return f'better than {comparison} (p={pnum:.3f})'
-        elif pnum < 0.05:
-            return f'worse than {comparison} (p={1-pnum:.3f})'
         else:
-            return f'indistinguishable from {comparison}'
-
-    p_random = stats.pvalue(correct, total, 1/3.)
-    # TODO(benkraft): Technically this should be something something two-sided,
-    # but the global number of votes should be high enough it's not a big deal.
-    p_average = stats.pvalue(correct, total, _global_average(year))
+            return f'worse than {comparison} (p={pnum:.3f})'
 
     streaks = []  # (veracity, length, start time, end time, broken by)
     for timestamp, veracity, user in votes:
@@ -557,41 +861,288 @@ def handle_mystats(args, channel, user_id):
     return (
         f'{heading}:\n'
         f'Record: {correct}/{total} ({percent:.0f}%)\n'
-        f'Statistically: {pvalue_text(p_random, "random")}, '
-        f'{pvalue_text(p_average, "the average user")}\n'
+        f'Statistically: {pvalue_text(1/3., "random")}, '
+        f'{pvalue_text(_global_average(team_id, year), "the average user")}\n'
         f'{historical_streak_text(longest_correct_streak)}\n'
         f'{historical_streak_text(longest_incorrect_streak)}\n'
         f'{current_streak_text(current_streak)}\n'
     )
 
 
+SEARCH_PAGE_SIZE = 10
+# Words, or key:value filters, where the value may be "quoted with spaces".
+# (Not shlex, since statements are full of apostrophes.)
+SEARCH_TERM_RE = re.compile(r'\w+:"[^"]*"|\S+')
+DUPLICATE_THRESHOLD = 0.8
+VERACITY_TO_STATEMENT_TYPE = {
+    True: 'truth',
+    False: 'lie',
+    None: 'open',
+}
+
+
+def _add_team_columns(team_id):
+    """Adds team_id to tables from before we supported multiple workspaces.
+
+    Existing rows are assigned to team_id, i.e. whichever workspace ran
+    __createtables; new tables already have the column and indexes.
+    """
+    inspector = db.inspect(db.engine)
+    quote = db.engine.dialect.identifier_preparer.format_table
+    for model in (User, Statement, Vote, Poll):
+        table = model.__table__
+        columns = {column['name']
+                   for column in inspector.get_columns(table.name)}
+        if 'team_id' not in columns:
+            with db.engine.begin() as conn:
+                conn.execute(db.text(
+                    f'ALTER TABLE {quote(table)} '
+                    f'ADD COLUMN team_id VARCHAR(32)'))
+            model.query.filter(model.team_id.is_(None)).update(
+                {'team_id': team_id}, synchronize_session=False)
+            db.session.commit()
+
+        indexes = {index['name']
+                   for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(bind=db.engine)
+
+
+def _create_search_index():
+    """Creates the full-text index on statement text, if it's not there.
+
+    In sqlite (i.e. DEBUG), that's an FTS5 table kept in sync by triggers;
+    in MySQL it's a FULLTEXT index.
+    """
+    table = Statement.__tablename__
+    if db.engine.dialect.name == 'sqlite':
+        ddl = [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts "
+            f"USING fts5(text, content='{table}', content_rowid='id')",
+            f"CREATE TRIGGER IF NOT EXISTS {table}_fts_insert "
+            f"AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {table}_fts(rowid, text) VALUES (new.id, new.text); "
+            f"END",
+            f"CREATE TRIGGER IF NOT EXISTS {table}_fts_delete "
+            f"AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {table}_fts({table}_fts, rowid, text) "
+            f"VALUES ('delete', old.id, old.text); "
+            f"END",
+            f"CREATE TRIGGER IF NOT EXISTS {table}_fts_update "
+            f"AFTER UPDATE OF text ON {table} BEGIN "
+            f"INSERT INTO {table}_fts({table}_fts, rowid, text) "
+            f"VALUES ('delete', old.id, old.text); "
+            f"INSERT INTO {table}_fts(rowid, text) VALUES (new.id, new.text); "
+            f"END",
+            # Index anything that was there before the triggers were.
+            f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')",
+        ]
+    else:
+        indexes = db.inspect(db.engine).get_indexes(table)
+        if any(index['name'] == f'{table}_text_fulltext'
+               for index in indexes):
+            return
+        ddl = [f"CREATE FULLTEXT INDEX {table}_text_fulltext "
+               f"ON {table} (text)"]
+
+    with db.engine.begin() as conn:
+        for statement in ddl:
+            conn.execute(db.text(statement))
+
+
+def _fulltext_match(text):
+    table = Statement.__tablename__
+    if db.engine.dialect.name == 'sqlite':
+        return db.text(
+            f"{table}.id IN (SELECT rowid FROM {table}_fts "
+            f"WHERE {table}_fts MATCH :query)"
+        ).bindparams(query=search.fts5_query(text))
+    else:
+        return db.text(
+            f"MATCH ({table}.text) AGAINST (:query IN BOOLEAN MODE)"
+        ).bindparams(query=search.mysql_query(text))
+
+
+def _search_statements(team_id, text, teller=None, year=None, veracity=None,
+                       before=None, limit=SEARCH_PAGE_SIZE):
+    """Returns statements matching the given text and filters, newest first.
+
+    Pages are keyed on statement id: pass the last id of one page as
+    `before` to get the next.
+    """
+    stmts = (db.session.query(Statement.id, Statement.text,
+                              Statement.timestamp, Statement.veracity,
+                              User.name)
+             .select_from(Statement).join(User)
+             .filter(Statement.team_id == team_id))
+    if search.tokenize(text):
+        stmts = stmts.filter(_fulltext_match(text))
+    if teller:
+        teller = re.sub(r'([\\%_])', r'\\\1', teller)
+        stmts = stmts.filter(User.name.ilike(f'%{teller}%', escape='\\'))
+    stmts = _maybe_filter_stmts_for_year(stmts, year)
+    if veracity is not None:
+        stmts = stmts.filter(Statement.veracity == veracity)
+    if before:
+        stmts = stmts.filter(Statement.id < before)
+    return stmts.order_by(Statement.id.desc()).limit(limit).all()
+
+
+def handle_search(args, channel, user_id):
+    usage = ('usage: search [words] [teller:name] [year:YYYY] '
+             '[is:truth|is:lie] [before:id]')
+    words = []
+    filters = {}
+    for term in SEARCH_TERM_RE.findall(args):
+        key, _, value = term.partition(':')
+        value = value.strip('"')
+        if key == 'teller' and value:
+            filters['teller'] = value
+        elif key in ('year', 'before') and value:
+            if not value.isdigit() or (
+                    key == 'year' and not
+                    datetime.MINYEAR <= int(value) < datetime.MAXYEAR):
+                return f"{value} doesn't seem like a valid {key} to me!"
+            filters[key] = int(value)
+        elif key == 'is' and value in ('truth', 'lie'):
+            filters['veracity'] = value == 'truth'
+        else:
+            words.append(term)
+
+    text = ' '.join(words)
+    if not search.tokenize(text) and not filters.get('teller'):
+        return usage
+
+    # Fetch one extra so we know whether there's another page.
+    stmts = _search_statements(_current_team_id(), text,
+                               limit=SEARCH_PAGE_SIZE + 1, **filters)
+    if not stmts:
+        return 'No matching statements found!'
+
+    lines = [
+        f'#{id} {name}, {timestamp.strftime("%x")}, '
+        f'{VERACITY_TO_STATEMENT_TYPE[veracity]}: {text}'
+        for id, text, timestamp, veracity, name
+        in stmts[:SEARCH_PAGE_SIZE]]
+    if len(stmts) > SEARCH_PAGE_SIZE:
+        next_args = re.sub(r'\s*\bbefore:\S*', '', args).strip()
+        lines.append(f'More: `/twotruths search {next_args} '
+                     f'before:{stmts[SEARCH_PAGE_SIZE - 1][0]}`')
+    return '\n'.join(lines)
+
+
+def handle_dupes(args, channel, user_id):
+    year, heading = _coerce_year(args, "%s Possible Duplicates")
+    stmts = (db.session.query(Statement.id, Statement.text)
+             .filter(Statement.team_id == _current_team_id()))
+    stmts = _maybe_filter_stmts_for_year(stmts, year).all()
+
+    pairs = search.near_duplicates(stmts, DUPLICATE_THRESHOLD)
+    if not pairs:
+        return 'No duplicate statements found!'
+
+    texts = dict(stmts)
+    return '%s:\n%s' % (heading, '\n'.join(
+        f'#{first} and #{second} ({100 * score:.0f}% similar): '
+        f'{texts[second]}'
+        for first, second, score in pairs[:SEARCH_PAGE_SIZE]))
+
+
+# team id -> similarity.VoteMatrix, loaded on first use.
+_vote_matrices = {}
+# team id -> lock held while loading or adding to the team's VoteMatrix.
+_vote_matrix_locks = {}
+MIN_SHARED_POLLS = 5
+# Stream votes in batches of this many, rather than loading them all at once.
+VOTE_BATCH_SIZE = 5000
+NUM_TWINS = 3
+
+
+def _vote_matrix(team_id):
+    """Returns the team's VoteMatrix, with any votes it doesn't have yet."""
+    with _vote_matrix_locks.setdefault(team_id, threading.Lock()):
+        matrix = _vote_matrices.get(team_id) or similarity.VoteMatrix()
+        votes = (db.session.query(Vote.id, Vote.slack_user_id,
+                                  Vote.statement_id, Statement.user_id)
+                 .select_from(Vote).join(Statement)
+                 .filter(Vote.team_id == team_id)
+                 .filter(Vote.id > matrix.last_vote_id)
+                 .yield_per(VOTE_BATCH_SIZE))
+        matrix.add_votes(votes)
+        _vote_matrices[team_id] = matrix
+    return matrix
+
+
+def handle_twins(args, channel, user_id):
+    team_id = _current_team_id()
+    others = _vote_matrix(team_id).agreement(
+        user_id, min_shared=MIN_SHARED_POLLS)
+    if not others:
+        return ("You haven't voted in enough of the same polls as anyone "
+                "else yet!")
+
+    def voter_text(other):
+        other_id, agreed, shared = other
+        return (f'{_get_user_real_name(team_id, other_id)}: agreed '
+                f'{100 * agreed / shared:.0f}% ({agreed}/{shared})')
+
+    twins = others[:NUM_TWINS]
+    contrarians = sorted(
+        others[NUM_TWINS:],
+        key=lambda other: (other[1] / other[2], -other[2]))[:NUM_TWINS]
+    agreed = sum(other[1] for other in others)
+    shared = sum(other[2] for other in others)
+
+    lines = ['Your voting twins (who picked the same lie as you most often):']
+    lines.extend(voter_text(other) for other in twins)
+    if contrarians:
+        lines.append(
+            'Your contrarians (who picked the same lie least often):')
+        lines.extend(voter_text(other) for other in contrarians)
+    lines.append(f'Overall, you agree with others '
+                 f'{100 * agreed / shared:.0f}% of the time.')
+    return '\n'.join(lines)
+
+
 def handle_help(args, channel, user_id):
     return ('To post the leaderboard in this channel, '
-            '`/twotruths leaderboard [year]`.\n'
+            '`/twotruths leaderboard [year] [metric] [page]`, where metric '
+            'is one of %s.\n'
             'To post the "winners" (by various measures) in this channel, '
             '`/twotruths winners [year]`.\n'
             # 'To post global stats in this channel, '
             # '`/twotruths stats [year]`.\n'
             'To see your personal stats, `/twotruths mystats [year]`.\n'
-            'To see this help, `/twotruths help`.')
+            'To see where you rank, `/twotruths myrank [year] [metric]`.\n'
+            'To see who votes like you, `/twotruths twins`.\n'
+            'To see this help, `/twotruths help`.'
+            % ', '.join(LEADERBOARD_METRICS))
 
 
 def handle_adminhelp(args, channel, user_id):
     return ('To enter statements, `/twotruths new`.\n'
             'To close voting, `/twotruths close :number-that-was-a-lie:`.\n'
+            'To search past statements, `/twotruths search [words] '
+            '[teller:name] [year:YYYY] [is:truth|is:lie]`.\n'
+            'To find statements that may have been entered twice, '
+            '`/twotruths dupes [year]`.\n'
             'To see this admin help, `/twotruths adminhelp`.\n'
             'To see help for user commands, `/twotruths help`.')
 
 
 def handle_debughelp(args, channel, user_id):
     return ('Commands include: '
-            '__createtables, __version, __whoami.\n'
+            '__createtables, __version, __whoami, '
+            '__profile <command> [args].\n'
             'Suffix any command with "__as @-mention" to impersonate a user.')
 
 
 def handle_createtables(args, channel, user_id):
     logging.warning("DATABASE URI:", DATABASE_URI)
     db.create_all()
+    _add_team_columns(_current_team_id())
+    _create_search_index()
     return ':+1:'
 
 
@@ -603,6 +1154,63 @@ def handle_whoami(args, channel, user_id):
     return f'Hello, <@{user_id}>!'
 
 
+PROFILE_TOP_N = 20
+# These change things, so profiling them would do more than just measure.
+UNPROFILEABLE_COMMANDS = {'new', 'close', '__createtables', '__profile'}
+
+
+def handle_profile(args, channel, user_id):
+    """Runs another command under cProfile, and reports where it was slow.
+
+    Anything the command would post to the channel is dropped.  The full
+    profile is saved, and can be downloaded from the link we reply with.
+    """
+    command, _, command_args = args.partition(' ')
+    if command not in HANDLERS or command in UNPROFILEABLE_COMMANDS:
+        return 'usage: __profile <command> [args]'
+
+    queries = []
+    thread = threading.get_ident()
+
+    def count_query(conn, cursor, statement, *args):
+        # The listener is for the whole engine; only count queries from this
+        # request, not others running on the instance at the same time.
+        if threading.get_ident() == thread:
+            queries.append(statement)
+
+    sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count_query)
+    flask.g.suppress_slack_posts = True
+    profiler = cProfile.Profile()
+    start = time.time()
+    try:
+        profiler.runcall(HANDLERS[command], command_args, channel, user_id)
+    finally:
+        elapsed = time.time() - start
+        flask.g.suppress_slack_posts = False
+        sqlalchemy.event.remove(
+            db.engine, 'before_cursor_execute', count_query)
+
+    profile_stats = pstats.Stats(profiler).sort_stats('cumulative')
+    top = '\n'.join(
+        '%8.3fs %7s %s' % (profile_stats.stats[func][3],
+                           profile_stats.stats[func][1],
+                           pstats.func_std_string(func))
+        for func in profile_stats.fcn_list[:PROFILE_TOP_N])
+
+    profile = Profile(id=secrets.token_hex(16), team_id=_current_team_id(),
+                      command=args, timestamp=datetime.datetime.utcnow(),
+                      data=marshal.dumps(profile_stats.stats))
+    db.session.add(profile)
+    db.session.commit()
+
+    url = flask.url_for('handle_profile_download', profile_id=profile.id,
+                        _external=True)
+    return (f'Profiled `{args}`: {elapsed:.3f}s, '
+            f'{len(queries)} SQL queries.\n'
+            f'Full profile (load with pstats or snakeviz): {url}\n'
+            f'```  cumtime  ncalls function\n{top}```')
+
+
 HANDLERS = {
     'new': handle_new,
     'close': handle_close,
@@ -610,11 +1218,16 @@ HANDLERS = {
     'winners': handle_winners,
     # 'stats': handle_stats,
     'mystats': handle_mystats,
+    'myrank': handle_myrank,
+    'twins': handle_twins,
+    'search': handle_search,
+    'dupes': handle_dupes,
     'help': handle_help,  # also the default
     'adminhelp': handle_adminhelp,
     '__createtables': handle_createtables,
     '__version': handle_version,
     '__whoami': handle_whoami,
+    '__profile': handle_profile,
 }
 
 
@@ -623,6 +1236,7 @@ def handle_slash_command():
     if flask.request.form.get('token') != app_secrets.VERIFICATION_TOKEN:
         return "unauthorized :(", 200
 
+    flask.g.team_id = flask.request.form.get('team_id')
     text = flask.request.form.get('text')
     channel = flask.request.form.get('channel_id')
     if '__as' in text:
@@ -641,6 +1255,8 @@ def handle_slash_command():
         if not isinstance(resp, str):
             return flask.jsonify(resp)
         return resp, 200
+    except InvalidInput as e:
+        return str(e), 200
     except Exception as e:
         logging.exception(e)
         # We have to give 200 (a lie), or Slack won't even show the message.
@@ -712,11 +1328,12 @@ def handle_new_submit(payload):
     if len(statements) != 3:
         return _error(statements=f'need 3 statements, got {len(statements)}')
 
-    u = User(name=name)
+    team_id = _current_team_id()
+    u = User(team_id=team_id, name=name)
     db.session.add(u)
     for statement in statements:
         db.session.add(
-            Statement(user=u, text=statement,
+            Statement(team_id=team_id, user=u, text=statement,
                       timestamp=datetime.datetime.utcnow()))
 
     message = ("Time to vote on %s's three statements!  "
@@ -732,7 +1349,7 @@ def handle_new_submit(payload):
                        {'name': emoji, 'channel': channel_id,
                         'timestamp': resp['ts']})
 
-    db.session.add(Poll(user=u, ts=resp['ts'],
+    db.session.add(Poll(team_id=team_id, user=u, ts=resp['ts'],
                         timestamp=datetime.datetime.now()))
     db.session.commit()
 
@@ -751,6 +1368,7 @@ MODAL_HANDLERS = {
 @app.route('/interactive', methods=['POST'])
 def handle_interactive():
     payload = json.loads(flask.request.form.get('payload'))
+    flask.g.team_id = payload['team']['id']
     type = payload.get('type')
     try:
         if type in ('block_actions', 'interactive_message'):
@@ -774,6 +1392,100 @@ def handle_interactive():
                 f"Diana Rosile for help."), 200
 
 
+# What the bot needs to be able to do, requested when it's installed.
+SLACK_SCOPES = ('commands', 'chat:write', 'chat:write.customize',
+                'reactions:read', 'reactions:write', 'users:read')
+OAUTH_STATE_COOKIE = 'oauth_state'
+
+
+@app.route('/install', methods=['GET'])
+def handle_install():
+    """Sends people to Slack to install us in a workspace.
+
+    Slack sends them back to /oauth with the state we pass along, which
+    must match the one in their cookie, so that no one else can trick them
+    into finishing an install they didn't start.
+    """
+    state = secrets.token_urlsafe(32)
+    resp = flask.redirect(
+        'https://slack.com/oauth/v2/authorize?' +
+        urllib.parse.urlencode({
+            'client_id': app_secrets.CLIENT_ID,
+            'scope': ','.join(SLACK_SCOPES),
+            'redirect_uri': flask.url_for('handle_oauth', _external=True),
+            'state': state,
+        }))
+    resp.set_cookie(OAUTH_STATE_COOKIE, state, max_age=10 * 60,
+                    secure=not app.debug, httponly=True)
+    return resp
+
+
+@app.route('/oauth', methods=['GET'])
+def handle_oauth():
+    """Where Slack sends people after they install us in a workspace."""
+    state = flask.request.args.get('state', '')
+    expected_state = flask.request.cookies.get(OAUTH_STATE_COOKIE, '')
+    if not expected_state or not secrets.compare_digest(
+            state, expected_state):
+        return "unauthorized :( -- try installing again from /install", 403
+
+    res = requests.post('https://slack.com/api/oauth.v2.access', data={
+        'client_id': app_secrets.CLIENT_ID,
+        'client_secret': app_secrets.CLIENT_SECRET,
+        'code': flask.request.args.get('code'),
+    }).json()
+    if not res.get('ok'):
+        logging.error("Install failed: %s", res)
+        return f"Something went wrong installing: {res.get('error')}", 200
+
+    db.session.merge(Team(id=res['team']['id'], name=res['team']['name'],
+                          bot_token=res['access_token']))
+    db.session.commit()
+    resp = flask.make_response(
+        "Installed!  Try `/twotruths help` in any channel.", 200)
+    resp.delete_cookie(OAUTH_STATE_COOKIE)
+    return resp
+
+
+@app.route('/profile/<profile_id>', methods=['GET'])
+def handle_profile_download(profile_id):
+    profile = Profile.query.get_or_404(profile_id)
+    return flask.Response(
+        profile.data, mimetype='application/octet-stream',
+        headers={'Content-Disposition':
+                 f'attachment; filename={profile.id}.prof'})
+
+
+@app.route('/cron/reports', methods=['GET'])
+def handle_cron_reports():
+    """Snapshots each team's reports for years that are over.
+
+    Run daily by cron.yaml.  Only years whose latest snapshot was taken
+    before the year ended need redoing; after that they can't change.  We
+    also refresh the current year, in case a snapshot on close failed.
+    """
+    # App Engine strips this header from requests not from cron.
+    if flask.request.headers.get('X-Appengine-Cron') != 'true':
+        return "unauthorized :(", 403
+
+    now = datetime.datetime.utcnow()
+    teams = (db.session.query(Statement.team_id,
+                              db.func.min(Statement.timestamp))
+             .group_by(Statement.team_id).all())
+    for team_id, first_timestamp in teams:
+        final = {
+            year for year, timestamp in
+            db.session.query(Report.year, Report.timestamp)
+            .filter(Report.team_id == team_id)
+            if timestamp >= datetime.datetime(year + 1, 1, 1)}
+        for year in range(first_timestamp.year, now.year + 1):
+            if year not in final:
+                logging.info("Snapshotting %s reports for %s", year, team_id)
+                _snapshot_report(team_id, year)
+                db.session.commit()
+    return 'OK', 200
+
+
 @app.route('/ping', methods=['GET'])
 def handle_ping():
     return 'OK', 200
@@ -781,6 +1493,8 @@ def handle_ping():
 
 @app.route('/_ah/warmup', methods=['GET'])
 def handle_warmup():
+    # Almost everyone gets compared to random guessing in mystats.
+    stats.precompute(1/3., 500)
     return 'OK', 200
 
 
@@ -0,0 +1,73 @@
+import collections
+import math
+import re
+
+
+WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return [word.lower() for word in WORD_RE.findall(text)]
+
+
+def fts5_query(text):
+    # Quote every term, so punctuation in what the user typed doesn't get
+    # interpreted as FTS5 query syntax.  Terms are implicitly ANDed.
+    return ' '.join('"%s"' % word for word in tokenize(text))
+
+
+# InnoDB doesn't index words shorter than innodb_ft_min_token_size, or in
+# its stopword list (these are the defaults), so requiring one of them in a
+# boolean-mode query means nothing matches.
+MYSQL_MIN_TOKEN_SIZE = 3
+MYSQL_STOPWORDS = frozenset(
+    'a about an are as at be by com de en for from how i in is it la of on '
+    'or that the this to was what when where who will with und www'.split())
+
+
+def mysql_query(text):
+    # For MATCH ... AGAINST (... IN BOOLEAN MODE): require every term we
+    # can, and skip the ones InnoDB can't find.
+    return ' '.join('+%s' % word for word in tokenize(text)
+                    if len(word) >= MYSQL_MIN_TOKEN_SIZE
+                    and word not in MYSQL_STOPWORDS)
+
+
+def near_duplicates(docs, threshold=0.8):
+    """Returns pairs of docs whose word sets are at least threshold similar.
+
+    docs is an iterable of (id, text); the return value is a list of
+    (id, id, jaccard similarity), most similar first.
+
+    Rather than comparing every pair, we use prefix filtering: order each
+    doc's words rarest-first; two docs can only be similar enough if they
+    share one of the first len - ceil(threshold * len) + 1 of those, so we
+    only need to index (and compare against) that prefix.
+    """
+    word_sets = {}
+    for id, text in docs:
+        words = frozenset(tokenize(text))
+        if words:
+            word_sets[id] = words
+
+    freqs = collections.Counter(
+        word for words in word_sets.values() for word in words)
+
+    index = collections.defaultdict(list)
+    pairs = []
+    for id, words in word_sets.items():
+        ordered = sorted(words, key=lambda word: (freqs[word], word))
+        prefix_len = len(ordered) - math.ceil(threshold * len(ordered)) + 1
+        candidates = set()
+        for word in ordered[:prefix_len]:
+            candidates.update(index[word])
+            index[word].append(id)
+
+        for other in candidates:
+            other_words = word_sets[other]
+            similarity = (len(words & other_words)
+                          / len(words | other_words))
+            if similarity >= threshold:
+                pairs.append((other, id, similarity))
+
+    return sorted(pairs, key=lambda pair: -pair[2])
@@ -0,0 +1,120 @@
+import array
+
+import numpy
+from scipy import sparse
+
+
+def _index(indexes, keys, key):
+    if key not in indexes:
+        indexes[key] = len(keys)
+        keys.append(key)
+    return indexes[key]
+
+
+class VoteMatrix(object):
+    """Who voted for what, as sparse voter x statement/poll matrices.
+
+    picks[voter, statement] is 1 if the voter picked that statement as the
+    lie, and voted[voter, poll] is 1 if they voted in that poll at all; so
+    for a given voter, picks tells us which polls they agreed with each
+    other voter in, and voted[voter] @ voted.T how many they could have.
+
+    Votes are only ever added (when a poll closes), so keeping this up to
+    date just means adding the entries for votes newer than last_vote_id.
+    add_votes() isn't safe to call from two threads at once, but
+    agreement() can run alongside it: the matrices are replaced, never
+    changed in place.
+    """
+    def __init__(self):
+        self.voters = {}        # slack user id -> row
+        self.voter_ids = []     # row -> slack user id
+        self.statements = {}    # statement id -> column of picks
+        self.statement_ids = []
+        self.polls = {}         # poll (teller's user id) -> column of voted
+        self.poll_ids = []
+        # column of picks -> column of voted for its poll
+        self.statement_polls = array.array('i')
+        # (picks, voted), as one attribute so they're swapped out together.
+        self.matrices = (sparse.csr_matrix((0, 0), dtype=numpy.int32),
+                         sparse.csr_matrix((0, 0), dtype=numpy.int32))
+        self.last_vote_id = 0
+
+    def _with_entries(self, matrix, rows, cols, num_cols):
+        shape = (len(self.voter_ids), num_cols)
+        # The same entries, with room for the new voters and columns.  (New
+        # rows are empty, so they just repeat the last row pointer.)
+        indptr = numpy.concatenate([
+            matrix.indptr,
+            numpy.full(shape[0] - matrix.shape[0], matrix.indptr[-1],
+                       dtype=matrix.indptr.dtype)])
+        matrix = sparse.csr_matrix(
+            (matrix.data, matrix.indices, indptr), shape=shape)
+        new = sparse.csr_matrix(
+            (numpy.ones(len(rows), dtype=numpy.int32),
+             (numpy.frombuffer(rows, dtype=numpy.int32),
+              numpy.frombuffer(cols, dtype=numpy.int32))),
+            shape=shape)
+        matrix = matrix + new
+        # Reacting with more than one number still only counts once.
+        matrix.data[:] = 1
+        return matrix
+
+    def add_votes(self, votes):
+        """Adds (vote id, slack user id, statement id, poll) tuples."""
+        rows = array.array('i')
+        statement_cols = array.array('i')
+        poll_cols = array.array('i')
+        last_vote_id = self.last_vote_id
+        for vote_id, voter, statement_id, poll in votes:
+            rows.append(_index(self.voters, self.voter_ids, voter))
+            poll_col = _index(self.polls, self.poll_ids, poll)
+            statement_col = _index(
+                self.statements, self.statement_ids, statement_id)
+            if statement_col == len(self.statement_polls):
+                self.statement_polls.append(poll_col)
+            statement_cols.append(statement_col)
+            poll_cols.append(poll_col)
+            last_vote_id = max(last_vote_id, vote_id)
+
+        if rows:
+            picks, voted = self.matrices
+            self.matrices = (
+                self._with_entries(
+                    picks, rows, statement_cols, len(self.statement_ids)),
+                self._with_entries(
+                    voted, rows, poll_cols, len(self.poll_ids)))
+        self.last_vote_id = last_vote_id
+
+    def agreement(self, voter, min_shared=1):
+        """Returns how often the voter agreed with each other voter.
+
+        The return value is a list of (slack user id, agreed, shared), where
+        shared is the number of polls they both voted in, most agreeable
+        first; voters who shared fewer than min_shared polls are left out.
+        """
+        picks, voted = self.matrices
+        row = self.voters.get(voter)
+        # (They may have been added since we got the matrices.)
+        if row is None or row >= picks.shape[0]:
+            return []
+
+        # Voters can react with more than one number, but agreeing on two
+        # lies in the same poll still only counts as agreeing once: count
+        # the polls in which each other voter picked any of the same lies.
+        cols = picks[row].indices
+        _, poll_of_col = numpy.unique(
+            [self.statement_polls[col] for col in cols], return_inverse=True)
+        by_poll = sparse.csr_matrix(
+            (numpy.ones(len(cols), dtype=numpy.int32),
+             (numpy.arange(len(cols)), poll_of_col)),
+            shape=(len(cols), poll_of_col.max() + 1))
+        agreed = numpy.asarray(
+            ((picks[:, cols] @ by_poll) > 0).sum(axis=1)).ravel()
+        shared = (voted[row] @ voted.T).toarray().ravel()
+        shared[row] = 0
+        others = numpy.flatnonzero(shared >= min_shared)
+        rates = agreed[others] / shared[others]
+        # Sort by rate, then by how much evidence we have for it.
+        order = numpy.lexsort((-shared[others], -rates))
+        return [(self.voter_ids[i], int(agreed[i]), int(shared[i]))
+                for i in others[order]]
@@ -1,10 +1,113 @@
+import array
+import collections
+import functools
 import math
+
 from scipy.stats import norm
 
 
+# Probabilities are rounded to one of this many buckets, so that the CDF
+# table below can be shared between calls with (nearly) the same p.
+P_BUCKETS = 1000
+
+# (n, p bucket) -> P(X <= k) for k in 0..n, where X ~ Binomial(n, p).
+# Rows are added as they're needed, from the row for n - 1 if we have it,
+# and the least recently used are dropped once the table holds more than
+# MAX_CDF_TABLE_VALUES values (8 bytes each).
+MAX_CDF_TABLE_VALUES = 250000
+_cdf_table = collections.OrderedDict()
+_cdf_table_size = 0
+
+
+def _bucket(p):
+    return min(P_BUCKETS, max(0, int(round(p * P_BUCKETS))))
+
+
+def _compute_cdf_row(n, p):
+    if p == 0:
+        return array.array('d', [1.0] * (n + 1))
+    elif p == 1:
+        return array.array('d', [0.0] * n + [1.0])
+
+    log_p = math.log(p)
+    log_q = math.log1p(-p)
+    log_n_factorial = math.lgamma(n + 1)
+    row = array.array('d')
+    total = 0.0
+    for k in range(n + 1):
+        total += math.exp(log_n_factorial - math.lgamma(k + 1)
+                          - math.lgamma(n - k + 1)
+                          + k * log_p + (n - k) * log_q)
+        row.append(min(total, 1.0))
+    row[n] = 1.0
+    return row
+
+
+def _cdf_row(n, bucket):
+    global _cdf_table_size
+    row = _cdf_table.get((n, bucket))
+    if row is not None:
+        _cdf_table.move_to_end((n, bucket))
+    else:
+        p = bucket / P_BUCKETS
+        prev = _cdf_table.get((n - 1, bucket))
+        if prev is None:
+            row = _compute_cdf_row(n, p)
+        else:
+            # P(X_n <= k) = (1 - p) P(X_n-1 <= k) + p P(X_n-1 <= k - 1)
+            row = array.array('d', [(1 - p) * prev[0]])
+            row.extend((1 - p) * prev[k] + p * prev[k - 1]
+                       for k in range(1, n))
+            row.append(1.0)
+        _cdf_table[(n, bucket)] = row
+        _cdf_table_size += len(row)
+        while _cdf_table_size > MAX_CDF_TABLE_VALUES:
+            _, evicted = _cdf_table.popitem(last=False)
+            _cdf_table_size -= len(evicted)
+    return row
+
+
+def precompute(p, max_n):
+    """Fills in the CDF table for p up to n = max_n, e.g. on warmup."""
+    bucket = _bucket(p)
+    for n in range(max_n + 1):
+        _cdf_row(n, bucket)
+
+
+def binom_test(correct, n, frac):
+    """Two-sided exact binomial test of whether correct/n differs from frac.
+
+    Like scipy.stats.binomtest, the p-value is the total probability of all
+    outcomes no more likely than the one observed.
+    """
+    row = _cdf_row(n, _bucket(frac))
+
+    def pmf(k):
+        return row[k] - (row[k - 1] if k else 0.0)
+
+    observed = pmf(correct) * (1 + 1e-7)
+    # The pmf is unimodal, so the outcomes at most as likely as the observed
+    # one are everything below some low and above some high.
+    low = 0
+    while low <= n and pmf(low) <= observed:
+        low += 1
+    high = n
+    while high > low and pmf(high) <= observed:
+        high -= 1
+    pvalue = (row[low - 1] if low else 0.0) + (1 - row[high])
+    return min(pvalue, 1.0)
+
+
+@functools.lru_cache()
+def _z_score(ci):
+    return float(norm.ppf(1 - (1 - ci) / 2))  # two-sided
+
+
 def ci_bounds(correct, n, ci=0.90):
     # https://www.evanmiller.org/how-not-to-sort-by-average-rating.html
-    z = norm.ppf(1 - (1 - ci) / 2)  # two-sided
+    # This is called for every user on every leaderboard, so it sticks to
+    # the (cheap) Wilson interval rather than an exact one.
+    z = _z_score(ci)
     correct = float(correct)
     n = float(n)
     p = correct / n
@@ -14,8 +117,3 @@ def ci_bounds(correct, n, ci=0.90):
         (p * (1 - p) + (z * z) / (4 * n)) / n)
 
     return (center - err) / denom, (center + err) / denom
-
-
-def pvalue(correct, n, frac):
-    return norm.cdf(correct, loc=n * frac,
-                    scale=math.sqrt(n * frac * (1 - frac)))
@@ -1,4 +1,7 @@
+import collections
 import functools
+import threading
+import time
 
 
 _not_found = object()
@@ -13,3 +16,27 @@ def memo(f):
             retval = d[args] = f(*args)
         return retval
     return wrapped
+
+
+def ttl_memo(seconds, maxsize=1024):
+    """Like memo, but values expire after seconds, and at most maxsize are
+    kept (dropping the oldest)."""
+    def decorator(f):
+        d = collections.OrderedDict()   # args -> (expiry, value), oldest first
+        lock = threading.Lock()
+        @functools.wraps(f)
+        def wrapped(*args):
+            now = time.time()
+            with lock:
+                entry = d.get(args)
+            if entry is None or entry[0] <= now:
+                entry = (now + seconds, f(*args))
+                with lock:
+                    d.pop(args, None)
+                    d[args] = entry
+                    while (len(d) > maxsize
+                           or next(iter(d.values()))[0] <= now):
+                        d.popitem(last=False)
+            return entry[1]
+        return wrapped
+    return decorator